@@ -3,21 +3,40 @@
 """
 An easy-to-use parallel task runner based on the standard 'multiprocessing' library.
 The task to be executed must be a function that is defined in the global scope, i.e.,
-it cannot be a member function of a class.
+it cannot be a member function of a class. Worker processes are started with the
+'forkserver' method where available, so the function must also be importable from
+its module; in particular, it cannot be defined inside an 'if __name__ == "__main__"'
+block. For the same reason, a calling script must put its own top-level code under
+such a guard: the worker processes import the script, and would otherwise run that
+code again and fail to start, leaving run() waiting until its timeout expires.
 
 Example:
-    images = [load_image(name) for name in glob.glob("*.jpg")]
-    processed_images = multiproc.run(process_image, images)
+    def process_image(image):
+        ...
+
+    if __name__ == "__main__":
+        images = [load_image(name) for name in glob.glob("*.jpg")]
+        processed_images = multiproc.run(process_image, images)
 """
 
 from __future__ import print_function as _print_function
 
+import os                         # standard library
+import math                       # standard library
 import sys                        # standard library
+import atexit                     # standard library
 import signal                     # standard library
+import contextlib                 # standard library
 import time                       # standard library
-import multiprocessing            # standard library
+import pickle                     # standard library
 import tempfile                   # standard library
-import functools                  # pip install functools
+import threading                  # standard library
+import multiprocessing            # standard library
+import functools                  # standard library
+import io                         # standard library
+import itertools                  # standard library
+from multiprocessing import shared_memory  # standard library
+from multiprocessing.reduction import ForkingPickler  # standard library
 
 ######################################################################################
 #
@@ -25,42 +44,97 @@ import functools                  # pip install functools
 #
 ######################################################################################
 
-def run(func, arg_list, nproc=None, timeout=3600, raise_exceptions=True):
+def run(func, arg_list, nproc=None, timeout=3600, raise_exceptions=True, preload=None,
+        pin_cores=False):
     """
     Executes the given function for each element of the given array of arguments.
-    A separate process is launched for each invocation. Each element in arg_list is
-    a tuple consisting of zero or more elements that are to be expanded and passed
-    as arguments to the given 'func'. Results are returned as an array of the same
-    size as the input, each output element corresponding to the input element at
-    the same index. To get clean log output in a multiprocessing context, console
-    output is buffered such that stdout and stderr are redirected to a temporary
-    file until the function has completed, and then written to stdout all at once.
-
-    By default, any exceptions raised by the child processes are propagated to the
-    caller. Unfortunately, this is sometimes causing all processes to freeze. As a
-    workaround, exceptions can be disabled by setting raise_exceptions to False, in
-    which case the exception and its stack trace are just printed to the console.
+    The invocations are distributed among a pool of worker processes. Each element
+    in arg_list is a tuple consisting of zero or more elements that are to be
+    expanded and passed as arguments to the given 'func'. Results are returned as
+    an array of the same size as the input, each output element corresponding to
+    the input element at the same index. To get clean log output in a multiprocessing
+    context, console output is buffered such that stdout and stderr are redirected
+    to an in-memory file until the function has completed, and then written to
+    stdout all at once. This includes output written directly to the file
+    descriptors by C extensions.
+
+    By default, the first exception raised by the child processes is propagated to
+    the caller. Exceptions that cannot be transferred across the process boundary,
+    because they cannot be pickled and unpickled, are replaced by a RuntimeError that
+    includes the original type, message, and stack trace. Exceptions can be disabled
+    by setting raise_exceptions to False, in which case the exception and its stack
+    trace are just printed to the console.
+
+    By default, 'nproc' equals the number of CPU cores that the calling process is
+    allowed to run on. The worker processes are kept alive after the call returns,
+    and are reused by subsequent calls with the same 'func' and 'nproc'. The function
+    is sent to each worker only once, when the worker is started, rather than along
+    with each task. Calling with a different 'func' replaces the existing workers;
+    a functools.partial that is re-created with equal arguments counts as the same.
+    All workers are shut down when the calling process exits.
+
+    The optional 'preload' is a list of module names, e.g., ["numpy", "torch"], to be
+    imported once by the 'forkserver' process that worker processes are started
+    from, so that each worker inherits them instead of importing them again. This
+    only takes effect if given before the first Pool has been created, because the
+    forkserver process is started only once per process lifetime.
+
+    If 'pin_cores' is True, each worker process is pinned to a distinct CPU core, in
+    round-robin order among the cores that the calling process is allowed to run
+    on, so that the operating system does not migrate it to another core and its
+    caches stay warm. This can speed up compute-bound tasks, but may slow things
+    down if other processes are competing for the same cores. Pinning is ignored
+    on platforms that do not support it, and changing 'pin_cores' between calls
+    replaces the existing workers.
+
+    Any large numpy arrays in arg_list, either as such or as elements of argument
+    tuples, are copied into shared memory instead of being pickled and sent to the
+    worker processes. The function receives a view into the shared memory block,
+    which is released when this call returns. Each occurrence of an array gets its
+    own copy, so modifications made to the array by the function are visible
+    neither to the caller nor to other tasks, just like with pickled arguments.
     """
+    if isinstance(preload, str):
+        raise TypeError("preload must be a list of module names, not a string")
+    nproc = nproc or _usable_cpu_count()
+    pool = _acquire_pool(nproc, func, preload, pin_cores)
+    call_id = next(_call_ids)
+    failed = False
+    shared_blocks = []
     try:
-        # Ctrl+C handling is very delicate in Python multiprocessing. The main
-        # process must be made to ignore Ctrl+C before a child process Pool is
-        # created; the original Ctrl+C handler must be restored after creating
-        # the Pool; map_async() must be used instead of the blocking map(); and
-        # there must be a timeout when waiting on the results, because signals
-        # are otherwise ignored.
-        orig_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        pool = multiprocessing.Pool(nproc)
-        signal.signal(signal.SIGINT, orig_handler)
-        runner = functools.partial(_run, func, raise_enabled=raise_exceptions)
-        map_results = pool.map_async(runner, arg_list)
-        results = map_results.get(timeout)  # wait for N seconds before terminating
-        pool.close()
+        # Ctrl+C handling is very delicate in Python multiprocessing: the blocking
+        # map() must not be used, and there must be a timeout when waiting on the
+        # results, because signals are otherwise ignored. Tasks are grouped into
+        # chunks here rather than by imap_unordered(), as that would not support
+        # waiting with a timeout. Each chunk is tagged with the index of its first
+        # task only, and its results are put back in input order as they arrive.
+        # Chunks are also tagged with the ID of this call, so that a failure can
+        # be confined to this call when other threads are sharing the same Pool.
+        # Wrap single arguments into 1-tuples here, once, so that the workers can
+        # always call func(*args) without checking.
+        arg_list = [args if isinstance(args, tuple) else (args,) for args in arg_list]
+        arg_list = _share_arrays(arg_list, shared_blocks)
+        results = [None] * len(arg_list)
+        if timeout is not None:
+            deadline = time.monotonic() + timeout  # wait for N seconds before terminating
+        chunksize = max(1, len(arg_list) // (nproc * 4))  # amortize IPC overhead
+        chunks = [(call_id, start, arg_list[start:start + chunksize])
+                  for start in range(0, len(arg_list), chunksize)]
+        runner = functools.partial(_run_chunk, raise_enabled=raise_exceptions)
+        result_iter = pool.imap_unordered(runner, chunks)
+        for _ in range(len(chunks)):
+            remaining = None if timeout is None else max(deadline - time.monotonic(), 0)
+            start, chunk_results = result_iter.next(remaining)
+            results[start:start + len(chunk_results)] = chunk_results
         return results
     except BaseException:
-        pool.terminate()
+        failed = True
         raise
     finally:
-        pool.join()
+        _release_pool(nproc, pool, failed)
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
 
 def cpu_count():
     """
@@ -74,47 +148,421 @@ def cpu_count():
 #
 ######################################################################################
 
-def _run_buffered(func, raise_enabled):
+_pool_cache = {}     # {nproc: (func, pin_cores, pool)}
+_pool_users = {}     # {pool: [number of run() calls using it, whether any failed]}
+_pool_lock = threading.Lock()  # guards _pool_cache and _pool_users
+_capture = None      # set in each worker process by _init_worker()
+_func = None         # set in each worker process by _init_worker()
+_failed_call = None  # set in each worker process by _init_worker()
+_call_ids = itertools.count(1)  # unique ID for each run() call in this process
+_shm_attached = []   # shared memory blocks attached by this worker process
+_SHM_MIN_BYTES = 1 << 20  # smaller numpy arrays are pickled rather than shared
+
+def _usable_cpu_count():
+    """
+    Returns the number of CPU cores that this process is allowed to run on, which
+    may be less than cpu_count() if restricted by taskset, cgroups, or similar.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return cpu_count()
+
+def _acquire_pool(nproc, func, preload, pin_cores):
+    """
+    Returns a process Pool with the given number of worker processes, set up to run
+    the given function, and optionally pinned to distinct CPU cores. The Pool is
+    created on first use and reused on subsequent calls with the same settings; a
+    Pool with different settings is replaced, and shut down as soon as no other
+    thread is using it. The given modules, if any, are preloaded into the
+    forkserver process. Each call must be paired with a call to _release_pool().
+    """
+    with _pool_lock:
+        pool_func, pool_pinned, pool = _pool_cache.get(nproc, (None, None, None))
+        if pool is not None and (not _same_func(pool_func, func) or pool_pinned != pin_cores):
+            del _pool_cache[nproc]
+            if _pool_users[pool][0] == 0:
+                _shutdown_pool(pool)
+            pool = None
+        if pool is None:
+            pool = _create_pool(nproc, func, preload, pin_cores)
+            _pool_cache[nproc] = (func, pin_cores, pool)
+            _pool_users[pool] = [0, False]
+        _pool_users[pool][0] += 1
+        return pool
+
+def _same_func(func1, func2):
+    """
+    Returns True if the given functions are known to be equivalent, i.e., they are
+    the same function, or functools.partial objects that wrap equivalent functions
+    with equal arguments. This allows a partial that is re-created on every call,
+    e.g., inside a loop, to reuse the same Pool.
+    """
+    if func1 is func2:
+        return True
+    if isinstance(func1, functools.partial) and isinstance(func2, functools.partial):
+        try:
+            return bool(_same_func(func1.func, func2.func) and
+                        func1.args == func2.args and
+                        func1.keywords == func2.keywords)
+        except Exception:  # e.g., numpy arrays cannot be compared this way
+            return False
+    return False
+
+def _release_pool(nproc, pool, failed):
+    """
+    Releases a Pool obtained from _acquire_pool(). A Pool that has failed, e.g.,
+    timed out or been interrupted, is removed from the cache, so that it will not
+    be reused. A Pool that is no longer in the cache is shut down once its last
+    user has released it; if any of its users failed, its worker processes are
+    terminated rather than allowed to finish their current tasks.
+    """
+    with _pool_lock:
+        usage = _pool_users.get(pool)
+        if usage is None:  # already shut down by _close_pools() at exit
+            return
+        usage[0] -= 1
+        usage[1] = usage[1] or failed
+        cached = _pool_cache.get(nproc, (None, None, None))[-1] is pool
+        if cached and failed:
+            del _pool_cache[nproc]
+            cached = False
+        if not cached and usage[0] == 0:
+            _shutdown_pool(pool)
+
+def _shutdown_pool(pool):
+    """
+    Shuts down the given Pool, which must no longer be in use. Must be called while
+    holding _pool_lock.
+    """
+    failed = _pool_users.pop(pool)[1]
+    if failed:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+def _create_pool(nproc, func, preload, pin_cores):
+    """
+    Creates a new process Pool; see _acquire_pool().
+    """
+    ctx = _get_context()
+    if preload and ctx.get_start_method() == "forkserver":
+        ctx.set_forkserver_preload(["__main__"] + list(preload))
+    with _sigint_blocked():
+        core_counter = ctx.Value("i", 0) if pin_cores else None
+        initargs = (ctx.Lock(), ctx.Value("q", 0), func, core_counter)
+        pool = ctx.Pool(nproc, initializer=_init_worker, initargs=initargs)
+    return pool
+
+@contextlib.contextmanager
+def _sigint_blocked():
+    """
+    Ctrl+C handling is very delicate in Python multiprocessing. The main process
+    must not be interrupted by Ctrl+C while a child process Pool is being created,
+    or the Pool may be left half-constructed. This context manager blocks SIGINT
+    for its duration, and then restores the original signal mask, so that a Ctrl+C
+    pressed in the meantime is delivered rather than lost. On platforms without
+    pthread_sigmask(), i.e., Windows, Ctrl+C is ignored instead, and the original
+    handler restored afterwards. Note that this does not make worker processes
+    ignore Ctrl+C, because those started by the 'forkserver' do not inherit the
+    signal mask of the main process; the workers take care of that themselves in
+    _init_worker().
+    """
+    if hasattr(signal, "pthread_sigmask"):
+        orig_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+        try:
+            yield
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, orig_mask)
+    else:
+        orig_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, orig_handler)
+
+def _get_context():
+    """
+    Returns the 'forkserver' multiprocessing context if supported on this platform,
+    or the default context otherwise. Forking from a small server process is much
+    cheaper than forking a large parent process, and is safe with threads.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context()
+
+def _init_worker(stdout_lock, failed_call, func, core_counter):
+    """
+    Initializes a worker process with the given lock that is shared by all worker
+    processes in the Pool and serializes their writes to stdout; with the given
+    shared value that holds the ID of the latest run() call in which a task has
+    raised an exception; and with the given function that is to be run for each
+    task. Also allocates the console output buffer that is reused by all tasks
+    run in this worker. If a shared core counter is given, pins this worker to the
+    next CPU core in turn.
+
+    Worker processes ignore Ctrl+C; it is handled by the main process, which then
+    terminates the workers. Otherwise, every busy worker would also be interrupted
+    and print a KeyboardInterrupt traceback of its own.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if core_counter is not None and hasattr(os, "sched_setaffinity"):
+        with core_counter.get_lock():
+            worker_idx = core_counter.value
+            core_counter.value += 1
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[worker_idx % len(cores)]})
+    global _failed_call, _capture, _func  # pylint: disable=global-statement
+    _failed_call = failed_call
+    _capture = _OutputCapture(stdout_lock)
+    _func = func
+
+@atexit.register
+def _close_pools():
+    """
+    Shuts down all cached process Pools; called automatically at exit.
+    """
+    with _pool_lock:
+        while _pool_cache:
+            _, (_, _, pool) = _pool_cache.popitem()
+            _shutdown_pool(pool)
+
+def _run_buffered(func, args, raise_enabled):
     """
-    Executes the given function and returns the result. Buffers all console output
-    (stdout & stderr) into a temporary file until the function has completed, and
-    then writes it all to stdout at once. This makes console output readable when
-    multiple processes are writing to stdout/stderr at the same time.
+    Executes the given function with the given tuple of arguments and returns the
+    result. Buffers all console output (stdout & stderr) in memory until the function
+    has completed, and then writes it all to stdout at once. This makes console output
+    readable when multiple processes are writing to stdout/stderr at the same time.
     """
-    with tempfile.NamedTemporaryFile(mode="w+t", delete=True) as tmpfile:
+    with _capture:
         try:
-            result = None
-            stdout = sys.stdout
-            stderr = sys.stderr
-            sys.stdout = tmpfile
-            sys.stderr = tmpfile
-            result = func()
-            return result
-        except BaseException:
-            # The main process sometimes freezes if an exception is raised by a
-            # child process; this may be a bug in the multiprocessing module or
-            # we may be using it wrong. Either way, as a dirty workaround we're
-            # adding a short delay before raising exceptions across the process
-            # boundary. This does not fix the problem, but makes it happen much
-            # more rarely.
+            return func(*args)
+        except BaseException as exc:  # pylint: disable=broad-except
             if raise_enabled:
-                time.sleep(0.2)
-                raise
+                raise _picklable(exc)
             else:
                 import traceback
                 traceback.print_exc()
-        finally:
-            sys.stdout = stdout
-            sys.stderr = stderr
-            tmpfile.flush()
-            tmpfile.seek(0)
-            log = tmpfile.read()
-            print(log, end='')
-            sys.stdout.flush()
-
-def _run(func, args, raise_enabled):
-    func_with_args = lambda: func(*args) if isinstance(args, tuple) else func(args)
-    return _run_buffered(func_with_args, raise_enabled)
+
+def _picklable(exc):
+    """
+    Returns the given exception if it survives a round trip through pickle, or else
+    a RuntimeError with the type, message, and stack trace of the given exception.
+    An exception that cannot be unpickled, e.g., because its constructor takes
+    different arguments than it passes on to BaseException, would kill the result
+    handler thread of the Pool in the main process, freezing it.
+    """
+    try:
+        pickle.loads(ForkingPickler.dumps(exc))
+        return exc
+    except Exception:  # pylint: disable=broad-except
+        import traceback
+        tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        return RuntimeError("Unpicklable exception raised in child process:\n" + tb)
+
+class _OutputCapture(object):
+    """
+    Captures all console output of the current process into an in-memory file. The
+    stdout and stderr file descriptors are redirected, rather than just sys.stdout
+    and sys.stderr, so that output written directly to the file descriptors, e.g.,
+    by C extensions, is captured, too. Python-level output is line buffered to keep
+    it roughly in order with the rest. The file is allocated once and reused.
+
+    When used as a context manager, the captured output is written to stdout upon
+    exit, while holding the given lock; if nothing was captured, nothing is done.
+    """
+
+    def __init__(self, stdout_lock):
+        if hasattr(os, "memfd_create"):
+            self.fd = os.memfd_create("multiproc")
+        else:
+            self.tmpfile = tempfile.TemporaryFile()
+            self.fd = self.tmpfile.fileno()
+        encoding = sys.stdout.encoding or "utf-8"
+        self.stream = open(self.fd, "w", buffering=1, encoding=encoding,
+                           errors="replace", closefd=False)
+        self.saved = None
+        self.stdout_lock = stdout_lock
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        log = self.stop()
+        if log:
+            with self.stdout_lock:
+                _write_fd(sys.stdout.fileno(), log)
+        return False
+
+    def start(self):
+        """
+        Empties the capture file and starts redirecting all console output into it.
+        """
+        os.ftruncate(self.fd, 0)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.saved = (sys.stdout, sys.stderr, os.dup(1), os.dup(2))
+        os.dup2(self.fd, 1)
+        os.dup2(self.fd, 2)
+        sys.stdout = self.stream
+        sys.stderr = self.stream
+
+    def stop(self):
+        """
+        Restores the original console output, and returns everything that has been
+        captured since start() as bytes.
+        """
+        self.stream.flush()
+        sys.stdout, sys.stderr, stdout_fd, stderr_fd = self.saved
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+        if os.fstat(self.fd).st_size == 0:
+            return b""
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        return _read_fd(self.fd)
+
+def _read_fd(fd):
+    """
+    Reads the given file descriptor until end of file, bypassing the buffering of
+    Python file objects.
+    """
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+def _write_fd(fd, data):
+    """
+    Writes the given bytes to the given file descriptor, bypassing the buffering
+    of Python file objects.
+    """
+    while data:
+        data = data[os.write(fd, data):]
+
+def _run_chunk(chunk, raise_enabled):
+    # Once a task has raised an exception, the whole run() call will fail with that
+    # exception; any remaining tasks of the same call can thus be skipped without
+    # running them. Tasks are skipped rather than made to raise an exception of
+    # their own, so that the original exception is always the one that propagates
+    # to the caller. Tasks of other calls sharing the same Pool are not affected.
+    call_id, start, arg_list = chunk
+    try:
+        return start, [_run_shared(call_id, args, raise_enabled) for args in arg_list]
+    except BaseException:
+        _failed_call.value = call_id
+        raise
+
+def _run_shared(call_id, args, raise_enabled):
+    if _failed_call.value == call_id:
+        return None
+    if not any(isinstance(arg, _SharedArray) for arg in args):
+        return _run_buffered(_func, args, raise_enabled)
+    try:
+        args = _attach_arrays(args)
+        result = _run_buffered(_func, args, raise_enabled)
+        # The result may contain views into the shared memory blocks, which would
+        # keep them mapped in this process; pickling it here, while the blocks are
+        # still open, allows them to be closed before the result is sent.
+        return _PickledResult(result)
+    finally:
+        args = result = None
+        _detach_arrays()
+
+class _PickledResult(object):
+    """
+    A task result that has been pickled in advance by the worker process. When sent
+    to the main process, it is unpickled there into the original result.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, result):
+        buf = io.BytesIO()
+        ForkingPickler(buf, pickle.HIGHEST_PROTOCOL).dump(result)
+        self.data = buf.getvalue()
+
+    def __reduce__(self):
+        return pickle.loads, (self.data,)
+
+class _SharedArray(object):
+    """
+    A picklable reference to a numpy array that has been copied into a block of
+    shared memory by the parent process.
+    """
+    __slots__ = ("name", "shape", "dtype")
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+def _share_arrays(arg_list, shared_blocks):
+    """
+    Copies all plain numpy arrays of at least _SHM_MIN_BYTES in the given list of
+    argument tuples into shared memory, and returns a new argument list where each
+    such array is replaced by a _SharedArray. Smaller arrays are cheaper to pickle,
+    and subclasses such as masked arrays are left for pickle to handle in full. The
+    shared memory blocks are appended to the given list as soon as they have been
+    created, so that the caller can release them even if this function fails. If
+    numpy has not been imported by the caller, there can be no arrays, and the
+    arguments are returned unchanged.
+    """
+    numpy = sys.modules.get("numpy")
+    if numpy is None:
+        return arg_list
+
+    def share(arg):
+        if type(arg) is not numpy.ndarray:  # pylint: disable=unidiomatic-typecheck
+            return arg
+        if arg.nbytes < _SHM_MIN_BYTES or arg.dtype.hasobject:
+            return arg
+        shm = shared_memory.SharedMemory(create=True, size=arg.nbytes)
+        shared_blocks.append(shm)
+        numpy.frombuffer(shm.buf, arg.dtype, arg.size).reshape(arg.shape)[...] = arg
+        if os.name == "posix":
+            # The block persists until unlinked, so its file descriptor can be
+            # closed right away, to not run out of them with many large arrays.
+            shm.close()
+        return _SharedArray(shm.name, arg.shape, arg.dtype)
+
+    return [tuple(share(arg) for arg in args) for args in arg_list]
+
+def _attach_arrays(args):
+    """
+    Replaces each _SharedArray in the given tuple of task arguments by a numpy array
+    that is a view into the corresponding shared memory block.
+    """
+    def attach(arg):
+        if not isinstance(arg, _SharedArray):
+            return arg
+        import numpy
+        shm = shared_memory.SharedMemory(arg.name)
+        _shm_attached.append(shm)
+        # Unlike the ndarray() constructor, frombuffer() holds on to the buffer, so
+        # the block cannot be closed from under the array in _detach_arrays().
+        array = numpy.frombuffer(shm.buf, arg.dtype, math.prod(arg.shape))
+        return array.reshape(arg.shape)
+
+    return tuple(attach(arg) for arg in args)
+
+def _detach_arrays():
+    """
+    Closes the shared memory blocks attached by this worker process. A block that
+    is still referenced by an array, e.g., one that the task function has stored
+    in a global variable, or that is part of an exception traceback, cannot be
+    closed yet; such blocks are retried after the next task.
+    """
+    for shm in list(_shm_attached):
+        try:
+            shm.close()
+            _shm_attached.remove(shm)
+        except BufferError:
+            pass
 
 ######################################################################################
 #
@@ -122,12 +570,81 @@ def _run(func, args, raise_enabled):
 #
 ######################################################################################
 
+# The test functions must be importable by the worker processes, so they cannot be
+# defined inside the 'if __name__ == "__main__"' block.
+
+def _testprint(idx):  # must be in global scope
+    print("This is a print statement in child process #%d."%(idx))
+    return idx * 2
+
+def _testoswrite(idx):  # must be in global scope
+    print("This is a print statement in child process #%d, followed by..."%(idx))
+    os.write(1, b"...a direct write to the stdout file descriptor.\n")
+    return idx * 2
+
+def _testfunc(val):  # must be in global scope
+    import random
+    time.sleep(random.random())
+    return val * 2
+
+def _testsleep(val):  # must be in global scope
+    time.sleep(val)
+    return val
+
+def _testslice(arr):  # must be in global scope
+    return arr[::2]
+
+def _testshmmaps(arr):  # must be in global scope
+    if arr is not None:
+        return arr[::2]
+    time.sleep(0.1)  # keep this worker busy, so that the other workers get tasks
+    with open("/proc/self/maps") as maps:
+        return sum("/psm_" in line for line in maps)
+
+def _testinplace(arr, val):  # must be in global scope
+    arr += val
+    return float(arr.sum())
+
+def _testimported(module_name):  # must be in global scope
+    return module_name in sys.modules
+
+def _testaffinity(delay):  # must be in global scope
+    time.sleep(delay)  # keep this worker busy, so that the other workers get tasks
+    return os.getpid(), os.sched_getaffinity(0)
+
+def _testmultiarg(val1, val2):  # must be in global scope
+    result = val1 * val1 + val2 * val2
+    return result
+
+def _testexc(idx):  # must be in global scope
+    print("This is child process #%d raising a ValueError."%(idx))
+    raise ValueError("This is an intentional exception from child process #%d."%(idx))
+
+def _testabort(dirname, idx, delay):  # must be in global scope
+    if dirname is not None:
+        open(os.path.join(dirname, "%d"%(idx)), "w").close()  # mark this task as run
+    time.sleep(delay)
+    if idx == 0:
+        raise ValueError("This is an intentional exception from task #%d."%(idx))
+    return idx
+
+class _TestUnpicklableError(Exception):
+    def __init__(self, idx, msg):
+        Exception.__init__(self, "Child process #%d: %s"%(idx, msg))
+
+def _testunpicklable(idx):  # must be in global scope
+    raise _TestUnpicklableError(idx, "This exception cannot be unpickled.")
+
 if __name__ == "__main__":
 
     # pylint: disable=missing-docstring
 
     import unittest
-    import random
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
 
     class _TestMultiproc(unittest.TestCase):
 
@@ -149,6 +666,12 @@ if __name__ == "__main__":
             results = run(_testprint, args)
             self.assertEqual(results, expected)
 
+        def test_run_with_oswrite(self):
+            args = [1, 2, 3, 4, 5]
+            expected = [2, 4, 6, 8, 10]
+            results = run(_testoswrite, args)
+            self.assertEqual(results, expected)
+
         def test_partial(self):
             args = [1, 2, 3, 4, 5]
             expected = [101, 104, 109, 116, 125]
@@ -156,30 +679,162 @@ if __name__ == "__main__":
             results = run(partialfunc, args)
             self.assertEqual(results, expected)
 
+        def test_run_chunked(self):
+            args = [(i, i + 1) for i in range(1000)]
+            expected = [i * i + (i + 1) * (i + 1) for i in range(1000)]
+            results = run(_testmultiarg, args, nproc=2)
+            self.assertEqual(results, expected)
+
+        @unittest.skipIf(numpy is None, "numpy not installed")
+        def test_numpy_args(self):
+            arrays = [numpy.arange(n, dtype=numpy.float32) for n in (1, 1000, 1 << 19)]
+            args = [(arr, arr) for arr in arrays] + [(arrays[0], 3)]
+            expected = [arr * arr + arr * arr for arr in arrays] + [arrays[0] ** 2 + 9]
+            results = run(_testmultiarg, args)
+            for result, exp in zip(results, expected):
+                self.assertTrue(numpy.array_equal(result, exp))
+
+        @unittest.skipIf(numpy is None, "numpy not installed")
+        def test_numpy_views(self):
+            arr = numpy.arange(1 << 18).reshape(512, 512)
+            results = run(_testslice, [arr] * 20)
+            for result in results:
+                self.assertTrue(numpy.array_equal(result, arr[::2]))
+
+        @unittest.skipIf(numpy is None, "numpy not installed")
+        def test_numpy_inplace(self):
+            arr = numpy.zeros(1 << 18)
+            results = run(_testinplace, [(arr, i) for i in range(8)])
+            self.assertEqual(results, [float(i * arr.size) for i in range(8)])
+            self.assertEqual(arr.sum(), 0)
+
+        @unittest.skipIf(numpy is None, "numpy not installed")
+        def test_numpy_many(self):
+            arrays = [numpy.full(10, i) for i in range(5000)]
+            results = run(_testslice, arrays)
+            self.assertEqual([result[0] for result in results], list(range(5000)))
+
+        @unittest.skipIf(numpy is None, "numpy not installed")
+        @unittest.skipIf(not os.path.exists("/proc/self/maps"), "requires Linux")
+        def test_numpy_unmapped(self):
+            arrays = [numpy.ones(1 << 18) * i for i in range(8)]
+            results = run(_testshmmaps, arrays, nproc=2)
+            self.assertEqual([result[0] for result in results], list(range(8)))
+            results = run(_testshmmaps, [None] * 8, nproc=2)
+            self.assertEqual(results, [0] * 8)
+
+        @unittest.skipIf(numpy is None, "numpy not installed")
+        def test_numpy_subclass(self):
+            arr = numpy.ma.masked_array(numpy.arange(1 << 18), mask=numpy.arange(1 << 18) % 2)
+            results = run(_testslice, [arr])
+            self.assertIsInstance(results[0], numpy.ma.MaskedArray)
+            self.assertTrue(numpy.array_equal(results[0].mask, arr.mask[::2]))
+
+        def test_preload(self):
+            # The forkserver has already been started by other tests at this point,
+            # so preloading must be tested in a fresh interpreter.
+            import subprocess
+            script = ("import multiproc; "
+                      "print(multiproc.run(multiproc._testimported, ['xml.dom.minidom'], "
+                      "preload=%r))")
+            for preload, expected in [(["xml.dom.minidom"], "[True]"), (None, "[False]")]:
+                output = subprocess.check_output([sys.executable, "-c", script % preload],
+                                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+                self.assertEqual(output.decode().strip(), expected)
+            self.assertRaises(TypeError, lambda: run(_testmultiarg, [(1, 2)], preload="numpy"))
+
+        @unittest.skipUnless(hasattr(os, "sched_setaffinity"), "no sched_setaffinity")
+        def test_pin_cores(self):
+            nproc = min(4, len(os.sched_getaffinity(0)))
+            results = run(_testaffinity, [0.5] * nproc, nproc=nproc, pin_cores=True)
+            cores = dict(results)  # {pid: cores}
+            for worker_cores in cores.values():
+                self.assertEqual(len(worker_cores), 1)
+            self.assertEqual(len(set().union(*cores.values())), len(cores))
+
+        def test_pool_reuse(self):
+            args = [(1, 2), (3, 4)]
+            run(_testmultiarg, args, nproc=2)
+            pool = _pool_cache[2][-1]
+            run(_testmultiarg, args, nproc=2)
+            self.assertIs(_pool_cache[2][-1], pool)
+            run(_testfunc, [1, 2], nproc=2)
+            self.assertIsNot(_pool_cache[2][-1], pool)
+
+        def test_pool_reuse_partial(self):
+            run(functools.partial(_testmultiarg, val2=10), [1, 2], nproc=2)
+            pool = _pool_cache[2][-1]
+            results = run(functools.partial(_testmultiarg, val2=10), [1, 2], nproc=2)
+            self.assertEqual(results, [101, 104])
+            self.assertIs(_pool_cache[2][-1], pool)
+            results = run(functools.partial(_testmultiarg, val2=20), [1, 2], nproc=2)
+            self.assertEqual(results, [401, 404])
+            self.assertIsNot(_pool_cache[2][-1], pool)
+
+        def test_threads(self):
+            errors = []
+
+            def worker(func, args, expected):
+                try:
+                    for _ in range(5):
+                        self.assertEqual(run(func, args, nproc=2), expected)
+                except BaseException as exc:  # pylint: disable=broad-except
+                    errors.append(exc)
+
+            threads = [threading.Thread(target=worker, args=(_testmultiarg, [(1, 2)], [5])),
+                       threading.Thread(target=worker, args=(_testslice, [[1, 2, 3]], [[1, 3]]))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+
+        def test_timeout(self):
+            args = [1, 2, 3, 4, 5]
+            self.assertRaises(multiprocessing.TimeoutError, lambda: run(_testsleep, args, timeout=0.1))
+
+        def test_no_timeout(self):
+            args = [(1, 2), (3, 4)]
+            expected = [5, 25]
+            results = run(_testmultiarg, args, timeout=None)
+            self.assertEqual(results, expected)
+
         def test_exceptions(self):
             args = [1, 2, 3, 4, 5]
             self.assertRaises(ValueError, lambda: run(_testexc, args, raise_exceptions=True))
 
-        @staticmethod
-        def test_noexceptions():
-            args = [1, 2, 3, 4, 5]
-            run(_testexc, args, raise_exceptions=False)
+        def test_exceptions_abort(self):
+            with tempfile.TemporaryDirectory() as dirname:
+                args = [(dirname, idx, 0) for idx in range(100)]
+                self.assertRaises(ValueError, lambda: run(_testabort, args, nproc=1))
+                self.assertEqual(os.listdir(dirname), ["0"])
 
-    def _testprint(idx):  # must be in global scope
-        print("This is a print statement in child process #%d."%(idx))
-        return idx * 2
+        def test_exceptions_abort_threads(self):
+            errors = []
 
-    def _testfunc(val):  # must be in global scope
-        time.sleep(random.random())
-        return val * 2
+            def worker():  # fails while the main thread is using the same Pool
+                try:
+                    run(_testabort, [(None, 0, 0.3)], nproc=2)
+                except ValueError as exc:
+                    errors.append(exc)
 
-    def _testmultiarg(val1, val2):  # must be in global scope
-        result = val1 * val1 + val2 * val2
-        return result
+            thread = threading.Thread(target=worker)
+            thread.start()
+            time.sleep(0.1)  # let the other thread get its task running
+            args = [(None, idx, 0.05) for idx in range(1, 21)]
+            results = run(_testabort, args, nproc=2)
+            thread.join()
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(results, list(range(1, 21)))
+
+        def test_unpicklable_exceptions(self):
+            args = [1, 2, 3, 4, 5]
+            self.assertRaises(RuntimeError, lambda: run(_testunpicklable, args, timeout=10))
 
-    def _testexc(idx):  # must be in global scope
-        print("This is child process #%d raising a ValueError."%(idx))
-        raise ValueError("This is an intentional exception from child process #%d."%(idx))
+        @staticmethod
+        def test_noexceptions():
+            args = [1, 2, 3, 4, 5]
+            run(_testexc, args, raise_exceptions=False)
 
     print("--" * 35)
     SUITE = unittest.TestLoader().loadTestsFromTestCase(_TestMultiproc)